@@ -6,16 +6,36 @@ from netmiko import ConnectHandler
 import csv
 import logging
 import datetime
-import multiprocessing as mp
+import hashlib
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
 import difflib
-import filecmp
+import shelve
 import sys
+import threading
 import os
 
 # Module 'Global' variables
 DEVICE_FILE_PATH = 'inventory.csv' # file should contain a list of devices in format: ip,hostname,username,password,device_type
 CHANGELOG_FILE_NAME = 'changelog.txt' # file will be created to log changes
 BACKUPLOG_FILE_NAME = 'backup_log.txt' # file contains a list of backups
+MAX_CONCURRENT_SESSIONS = 64 # upper bound for SSH sessions and worker threads used at the same time
+WRITE_BUFFER_SIZE = 1 << 20 # buffer size used for writing backup files
+HASH_FILE_SUFFIX = '.sha1' # appended to a backup file name to store the hash of its contents
+DIFF_CACHE_FILE_NAME = '.diffcache' # file will be created in the backup directory to cache diffs between backups
+DIFF_CACHE_MAX_ENTRIES = 1000 # the diff cache is emptied once it holds this many diffs
+
+SEPARATOR = '-*-' * 10 # visual separator between steps, logged at debug level
+
+# module logger without its own level, separators are only shown when debug logging is enabled
+# (for example with enable_logging), the default root level WARNING hides them
+logger = logging.getLogger(__name__)
+
+# comparisons run in executor threads and shelve doesn't support concurrent access
+diff_cache_lock = threading.Lock()
 
 def enable_logging():
     # This function enables netmiko logging for reference
@@ -28,23 +48,22 @@ def get_devices_from_file(device_file):
 
     # creating empty structures
     device_list = list()
-    device = dict()
 
     # reading a CSV file with ',' as a delimeter
     with open(device_file, 'r') as f:
-        reader = csv.reader(f, delimiter=',')
-        # knowing that the first row is a header, skipping it
-        next(reader, None)
-        # for the following rows unparsing data to the dictionary
-        for row in reader:
-            print('Iventory file contains the following device: '+str(row))
-            print('-*-' * 10)
-            device['ip'] = row[0]
-            device['username'] = row[1]
-            device['password'] = row[2]
-            device['device_type'] = row[3]
-            device['secret'] = row[4]
-            device['hostname'] = row[5]
+        # the first row is a header, its column names become dictionary keys
+        reader = csv.DictReader(f, delimiter=',')
+        # an empty file has no header, so there are no devices
+        if reader.fieldnames is None:
+            return device_list
+        reader.fieldnames = [name.strip() for name in reader.fieldnames]
+        # every following row is parsed into a new dictionary
+        for device in reader:
+            # skipping rows without any data, e.g. a line containing only spaces
+            if not any(value.strip() for value in device.values() if isinstance(value, str)):
+                continue
+            print('Iventory file contains the following device: '+str(device))
+            logger.debug(SEPARATOR)
             device_list.append(device)
 
     # returning a list of dictionaries
@@ -56,60 +75,81 @@ def get_current_date_and_time():
 
     now = datetime.datetime.now()
 
-    #creating a formatted string
-    timestamp = str(now.year) + '_' + str(now.month) + '_' + str(now.day) + '-' + str(now.hour) + '_' + str(now.minute)
+    #creating a formatted string, zero-padded so that timestamps sort in chronological order
+    timestamp = now.strftime('%Y_%m_%d-%H_%M')
 
     # returns a string
     return timestamp
 
-def connect_to_device(device_to_connect):
+async def connect_to_device(device_to_connect):
     # This function opens a connection to the device using Netmiko
     # Requires a device dictionary as an input
     # The second possible implementation could look like:
     # connection = Netmiko(host = device['ip'], username = device['username'], password=device['password'],device_type=device['device_type'])
 
+    # Netmiko is blocking, so the SSH handshake is handed over to the executor
+    # while the event loop keeps serving other devices
+    loop = asyncio.get_running_loop()
+
     # connecting
-    connection = ConnectHandler (
+    connection = await loop.run_in_executor(None, lambda: ConnectHandler (
         host = device_to_connect['ip'],
         username = device_to_connect['username'],
         password=device_to_connect['password'],
         device_type=device_to_connect['device_type'],
-        secret=device_to_connect['secret']
-    )
+        secret=device_to_connect['secret'],
+        # pattern-based reads with short sleeps instead of the conservative defaults
+        fast_cli=True,
+        global_delay_factor=0.1,
+        session_log=None,
+        # failing fast on unreachable devices instead of holding a session slot
+        conn_timeout=10,
+        banner_timeout=10,
+        auth_timeout=10
+    ))
 
     print ('Opened connection to '+device_to_connect['ip'])
-    print('-*-' * 10)
+    logger.debug(SEPARATOR)
 
     # returns a "connection" object
     return connection
 
-def disconnect_from_device(connection):
+async def disconnect_from_device(connection):
     #This function terminates the connection to the device
 
-    connection.disconnect()
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, connection.disconnect)
     print ('Connection terminated')
-    print('-*-' * 10)
-
-def create_backup_directory(hostname):
+    logger.debug(SEPARATOR)
+
+@contextlib.asynccontextmanager
+async def device_session(device, semaphore):
+    # This function opens a session to the device that can be reused for several commands
+    # A session slot is taken before connecting, on exit the connection is terminated
+    # and the slot is given back, even if a command failed
+    # Requires a device dictionary and a semaphore limiting open sessions as an input
+    # Usage: async with device_session(device, semaphore) as session: ...
+
+    async with semaphore:
+        connection = await connect_to_device(device)
+        try:
+            yield connection
+        finally:
+            await disconnect_from_device(connection)
+
+def create_backup_directory(hostname, backup_dir):
     # This function creates a folder for each device if this folder doesn't exist
     # Folder name equals device hostname
-    # Requires hostname as an input
+    # Requires hostname and a path to the directory holding all backups as an input
 
-    # getting a path to the current working directory
-    path = os.getcwd()
-    # creating a path to the new directory
-    path = path+"/"+hostname
+    # creating a path to the new directory in the backup directory
+    path = os.path.join(backup_dir, hostname)
 
     # if this directory doesn't exist, it gets created
-    # ignored otherwise
-    try:
-        os.makedirs(path, exist_ok=True)
-    except OSError:
-        print("Creation of the directory %s failed" % path)
-        print('-*-' * 10)
-    else:
-        print("Successfully created the directory %s" % path)
-        print('-*-' * 10)
+    # ignored otherwise, any other error is raised since nothing can be backed up without it
+    os.makedirs(path, exist_ok=True)
+    print("Successfully created the directory %s" % path)
+    logger.debug(SEPARATOR)
 
     # returns a path to the new directory
     return path
@@ -121,163 +161,271 @@ def create_backup_file_name(hostname, today):
     # backup file name structure is hostname-yyyy_mm_dd-hh_mm
     backup_file_name = hostname + '-' + today + '.txt'
     print('Backup file name will be '+backup_file_name)
-    print('-*-' * 10)
+    logger.debug(SEPARATOR)
 
     # returns a string
     return backup_file_name
 
-def log_backups (last_backup, logfile_name):
-    # This function creates a file (if not present) and writes every new backup file name to the end of this file
+def log_backups (last_backup, logfile):
+    # This function writes every new backup file name to the end of the log file
     # As a result there is a file with contents of the directory
-    # Requires the name of the last backup file and the name of a log file
+    # Requires the name of the last backup file and a log file opened for appending
 
-    with open(logfile_name, 'a+') as file:
-        file.write(last_backup+'\n')
+    logfile.write(last_backup+'\n')
     print(last_backup + ' is added to the log file')
-    print('-*-'*10)
+    logger.debug(SEPARATOR)
 
-def create_backup(connection, backup_file_name, log_file_name, hostname):
+async def create_backup(connection, backup_file_name, log_file, hostname):
     # This function pulls running configuration from a device and writes it to the backup file
     # Requires as an input:
     # - connection object,
     # - backup file path
-    # - log file path (the file with a list of backup files)
+    # - log file opened for appending (the file with a list of backup files)
     # - device hostname
 
+    loop = asyncio.get_running_loop()
+
     # sending a CLI command using Netmiko and printing an output
     # should enter enable mode first
-    connection.enable()
-    output = connection.send_command('sh run')
+    await loop.run_in_executor(None, connection.enable)
+    # Netmiko waits for the device's own prompt, so this works for any platform accepting the command
+    output = await loop.run_in_executor(None, lambda: connection.send_command('show running-config', read_timeout=30))
     print('\n')
     print('Running configuration is... \n' + output)
     print('#' * 30 + '\n'*3)
-    print('-*-' * 10)
+    logger.debug(SEPARATOR)
 
     #creating a backup file and writing command output to it
-    with open(backup_file_name, 'w') as file:
-        file.write(output)
+    # encoding once and writing through a large buffer keeps big configurations to a few syscalls
+    output_bytes = output.encode('utf-8', errors='replace')
+    with open(backup_file_name, 'wb', buffering=WRITE_BUFFER_SIZE) as file:
+        file.write(output_bytes)
+
+    # storing the hash next to the backup, so comparisons don't need to read unchanged backups
+    with open(backup_file_name + HASH_FILE_SUFFIX, 'w') as file:
+        file.write(hashlib.sha1(output_bytes).hexdigest())
     print("Backup of " + hostname + " is complete!")
-    print('-*-' * 10)
+    logger.debug(SEPARATOR)
 
     # call a function to add this new backup file to a log-list
-    log_backups(backup_file_name, log_file_name)
+    log_backups(backup_file_name, log_file)
 
 def get_previous_backup_file(logfile_name):
     # This function returns the name of a previous backup file if it exists in the directory
     # Requires the path to the log file (a file with the list of all backups) as an input
 
-    # reading from the log file to the list
+    # reading from the log file line by line, keeping only the two latest entries
     with open (logfile_name,'r') as f1:
-        backup_list = f1.read().splitlines()
+        backup_list = collections.deque((line.rstrip('\n') for line in f1), maxlen=2)
 
         # if there is more than 1 backup, take the second latest
         if len(backup_list)>1:
-            previous_backup = backup_list[-2]
+            previous_backup = backup_list[0]
 
-        # if there is just a single backup, inform the user
+        # if there is just a single backup, there is nothing to compare to
         else:
-            previous_backup = 'nothing to compare to'
+            previous_backup = None
 
-    # returns the path to the precious backup or 'nothing to compare to'
+    # returns the path to the precious backup or None
     return previous_backup
 
-def compare_backup_with_the_previous(backup_file, changelog_file, log_file):
+def get_backup_hash(backup_file):
+    # This function returns the SHA-1 of a backup file
+    # The hash is read from the sidecar file written by create_backup,
+    # backups made before sidecar files existed are hashed from their contents
+    # Requires a path to the backup file as an input
+
+    try:
+        with open(backup_file + HASH_FILE_SUFFIX, 'r') as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        with open(backup_file, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+def get_delta(previous_backup_file, backup_file, previous_hash, current_hash, diff_cache_file):
+    # This function returns a unified diff between two backups as a list of lines
+    # Diffs are cached by the content hashes of both backups, so the same pair is never diffed twice
+    # Requires paths to the previous and the current backup, their hashes and a path to the diff cache as an input
+
+    cache_key = previous_hash + ':' + current_hash
+
+    with diff_cache_lock, shelve.open(diff_cache_file, flag='c') as cache:
+        if cache_key in cache:
+            return cache[cache_key]
+
+    # reading each backup once, difflib needs both sides as sequences of lines
+    # backups are written as UTF-8 by create_backup, so they are decoded the same way regardless of the locale
+    with open(previous_backup_file,'r', encoding='utf-8', errors='replace') as f1, open(backup_file,'r', encoding='utf-8', errors='replace') as f2:
+        previous_lines = f1.read().splitlines()
+        current_lines = f2.read().splitlines()
+
+    delta_list = list(difflib.unified_diff(previous_lines, current_lines, lineterm=''))
+
+    with diff_cache_lock, shelve.open(diff_cache_file, flag='c') as cache:
+        # keeping the cache from growing forever, stale entries are simply computed again
+        if len(cache) >= DIFF_CACHE_MAX_ENTRIES:
+            cache.clear()
+        cache[cache_key] = delta_list
+
+    # returns a list of strings
+    return delta_list
+
+def compare_backup_with_the_previous(backup_file, changelog_file, log_file, diff_cache_file):
     # This function compares created backup with the previous one and writes delta to the changelog file
     # Requires as an input:
     # - a path to the backup file,
     # - a path to changelog file
     # - a path to a backup log file (with a list of backups)
+    # - a path to the diff cache
 
     # call a function to get the previous backup file name from a backup log file
-    # if there are no backups in a directory, it returns 'nothing to compare to'
+    # if there are no earlier backups in a directory, it returns None
     previous_backup_file = get_previous_backup_file(log_file)
 
     # if there was an earlier backup, comparing the new one to it
-    if previous_backup_file != 'nothing to compare to':
+    if previous_backup_file:
 
-        # checking if files differ from each other
-        if not filecmp.cmp(previous_backup_file, backup_file):
+        # comparing hashes first, backups are only read when their contents differ
+        previous_hash = get_backup_hash(previous_backup_file)
+        current_hash = get_backup_hash(backup_file)
+
+        # looking for delta, identical files produce an empty delta
+        if previous_hash == current_hash:
+            delta_list = list()
+        else:
+            delta_list = get_delta(previous_backup_file, backup_file, previous_hash, current_hash, diff_cache_file)
 
-            # if they do differ, open backup files in read mode and open/create changelog file for appending
-            with open(previous_backup_file,'r') as f1, open(backup_file,'r') as f2, open(changelog_file,'a+') as f3:
+        # checking if files differ from each other
+        if delta_list:
 
-                # looking for delta
-                delta = difflib.unified_diff(f1.read().splitlines(),f2.read().splitlines())
+            # if they do differ, open/create changelog file for appending
+            with open(changelog_file,'a+', encoding='utf-8') as f3:
 
                 # writing discovered delta to the changelog file
                 f3.write(backup_file + ' contains the following changes comparing to '+ previous_backup_file + ':\n')
-                f3.write('\n'.join(delta))
+                f3.write('\n'.join(delta_list))
                 f3.write('\n'+'*'*20 + '\n'*5)
             print ('Logged changes to ' + changelog_file)
-            print('-*-' * 10)
+            logger.debug(SEPARATOR)
 
 
         else:
             # if there is no difference, leave a comment to the changelog file
-            with open(changelog_file,'a+') as f3:
+            with open(changelog_file,'a+', encoding='utf-8') as f3:
                 print(backup_file,' contains 0 changes comparing to ',previous_backup_file,':\n')
                 f3.write(backup_file + ' contains 0 changes comparing to '+ previous_backup_file + ':\n')
                 f3.write('\n'+'*' * 20 + '\n'*5)
             print ('There are no changes to log this time')
-            print('-*-' * 10)
+            logger.debug(SEPARATOR)
 
     else:
         print ('There is nothing to compare the following backup to this time: ',backup_file)
-        print('-*-' * 10)
+        logger.debug(SEPARATOR)
 
-def process_target(device,timestamp):
-    # This function will be run by each of the processes in parallel
+async def process_target(device, timestamp, semaphore, backup_dir):
+    # This function will be run for each of the devices concurrently on a single event loop
     # This function implements a logic for a single device using other functions defined above:
     #  - creates a directory for backups if it doesn't exist,
-    #  - creates full path to backup related files,
     #  - connects to the device,
+    #  - creates full path to backup related files,
     #  - creates a backup for this device,
     #  - terminates connection,
     #  - compares a backup to the previous one and logs the delta
-    # Requires connection object and a timestamp string as an input
+    # Requires a device dictionary, a timestamp string, a semaphore limiting open sessions
+    # and a path to the backup directory as an input
 
-    path = create_backup_directory(device['hostname'])
+    hostname = device['hostname']
 
-    # creating a path to all files to be created
-    backup_file_path = path+'/'+create_backup_file_name(device['hostname'], timestamp)
-    backuplog_file_path = path +'/'+ BACKUPLOG_FILE_NAME
-    changelog_file_path = path +'/'+ CHANGELOG_FILE_NAME
+    # the device directory is created before connecting, so a directory that can't be created
+    # fails this device without opening a connection
+    # the directory is resolved once and reused for every file below
+    device_dir = create_backup_directory(hostname, backup_dir)
 
-    # connecting to a device
-    connection = connect_to_device(device)
+    # the session owns the connection and its slot, so every step below runs inside it
+    # and the connection is terminated when the session is closed, whatever fails
+    async with device_session(device, semaphore) as session:
 
-    # creating a backup file and terminating connection
-    create_backup(connection, backup_file_path, backuplog_file_path, device['hostname'])
-    disconnect_from_device(connection)
+        # creating a path to all files to be created
+        backup_file_path = os.path.join(device_dir, create_backup_file_name(hostname, timestamp))
+        backuplog_file_path = os.path.join(device_dir, BACKUPLOG_FILE_NAME)
+        changelog_file_path = os.path.join(device_dir, CHANGELOG_FILE_NAME)
+
+        # opening the backup log once per device, line buffering flushes every entry as it is written
+        with open(backuplog_file_path, 'a', buffering=1) as backuplog_file:
+            # creating a backup file
+            await create_backup(session, backup_file_path, backuplog_file, hostname)
 
     # comparing to the previous backup
-    compare_backup_with_the_previous(backup_file_path, changelog_file_path, backuplog_file_path)
+    loop = asyncio.get_running_loop()
+    diff_cache_file_path = os.path.join(backup_dir, DIFF_CACHE_FILE_NAME)
+    await loop.run_in_executor(None, compare_backup_with_the_previous, backup_file_path, changelog_file_path, backuplog_file_path, diff_cache_file_path)
+
+async def backup_device(device, timestamp, semaphore, backup_dir):
+    # This function runs process_target for a single device and reports a failure together with the device,
+    # so a failed backup doesn't cancel the others
+    # Requires the same input as process_target
+
+    try:
+        await process_target(device, timestamp, semaphore, backup_dir)
+    except Exception as error:
+        print('Backup of ' + str(device.get('hostname')) + ' (' + str(device.get('ip')) + ') failed: ', error)
+
+async def process_all_targets(device_list, timestamp, backup_dir, concurrency):
+    # This function starts process_target for all devices at once, each device backs up
+    # as soon as its own connection is open, so slow handshakes overlap with faster devices' backups
+    # Requires a device list, a timestamp string, a path to the backup directory
+    # and the maximum number of concurrent sessions as an input
+
+    # blocking Netmiko calls are executed in a thread pool sized to the session limit,
+    # Netmiko spends its time waiting on sockets, so threads are enough and much cheaper than processes
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(max_workers=concurrency))
+
+    # limiting the number of SSH sessions open at the same time
+    semaphore = asyncio.Semaphore(concurrency)
+
+    print('Connecting to all devices...')
+    # starting all devices right away and waiting for them to finish before executing the rest of the script
+    await asyncio.gather(*[backup_device(device, timestamp, semaphore, backup_dir) for device in device_list])
+
+def positive_int(value):
+    # This function converts a command line value to an integer greater than zero
+    # Requires a string as an input
+
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError('must be a positive integer, got %s' % value)
+
+    # returns an integer
+    return number
+
+def parse_arguments(args):
+    # This function parses command line arguments
+    # Requires a list of argument strings as an input
+
+    parser = argparse.ArgumentParser(description='Back up running configuration of network devices')
+    # backup paths are written to the backup log and read back later, so they are kept absolute
+    parser.add_argument('--backup-dir', type=os.path.abspath, default=os.getcwd(), help='directory for backups, defaults to the current working directory')
+    parser.add_argument('--inventory', default=DEVICE_FILE_PATH, help='CSV file with a list of devices, defaults to ' + DEVICE_FILE_PATH)
+    parser.add_argument('--concurrency', type=positive_int, default=MAX_CONCURRENT_SESSIONS, help='maximum number of SSH sessions open at the same time')
+
+    # returns a namespace with parsed arguments
+    return parser.parse_args(args)
 
 def main(*args):
     # This is a main function
 
+    # getting the options from the command line
+    arguments = parse_arguments(args)
+
     # getting the timestamp string
     timestamp = get_current_date_and_time()
 
     # getting a device list from the file in a python format
-    device_list = get_devices_from_file(DEVICE_FILE_PATH)
-
-    # creating a blanc list
-    processes=list()
-
-    # creating a dedicated process for each device and adding to the list
-    for device in device_list:
-        processes.append(mp.Process(target=process_target,args=(device,timestamp)))
-
-    print ('Starting several processes...')
-    # starting processes
-    for process in processes:
-        process.start()
+    device_list = get_devices_from_file(arguments.inventory)
 
-    print('Merging several processes...')
-    # waiting for processes to finish before executing the rest of the script
-    for process in processes:
-        process.join()
+    # running all devices concurrently on a single event loop
+    asyncio.run(process_all_targets(device_list, timestamp, arguments.backup_dir, arguments.concurrency))
 
 if __name__ == '__main__':
     # checking if we run independently